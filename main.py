@@ -7,25 +7,19 @@ import os
 import os.path
 import json
 import cjson
+import fcntl
+import warnings
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from tempfile import mkstemp
 from subprocess import check_call
-from time import sleep, mktime
+from time import time, sleep, mktime
 from datetime import datetime
 from collections import namedtuple, defaultdict, Counter
 from itertools import islice
 from xml.etree import ElementTree
 from hashlib import md5
 
-import requests
-requests.packages.urllib3.disable_warnings()
-
-import seaborn as sns
-import pandas as pd
-from matplotlib import pyplot as plt
-from matplotlib import rc
-# For cyrillic labels
-rc('font', family='Verdana', weight='normal')
-
-from skimage import io
 import numpy as np
 
 
@@ -45,6 +39,16 @@ MUSICBRAINZ_API = 'http://musicbrainz.org/ws/2/'
 COVERS_DIR = 'covers'
 COVERS_GRID = 'covers.png'
 
+DUMPS_MANIFEST = 'manifest.jsonl'
+DUMPS_MANIFEST_LOCK = 'manifest.jsonl.lock'
+DUMPS_BATCH = 100
+# Temp files of running writers live for milliseconds, older ones are
+# left by killed runs
+DUMPS_TMP_TTL = 60 * 60
+
+# Bytes of query to candidate distances computed at once
+AUDIO_DISTANCES_BLOCK = 16 * 2 ** 20
+
 
 LastfmArtist = namedtuple('LastfmArtist', ['name', 'image'])
 LastfmAlbum = namedtuple('LastfmAlbum', ['name', 'image', 'mbid'])
@@ -69,9 +73,135 @@ Track = namedtuple(
     'Track',
     ['artist', 'album', 'name', 'listened', 'audio']
 )
+TracksIndex = namedtuple(
+    'TracksIndex',
+    ['tracks', 'timestamps', 'artists', 'artist_tracks']
+)
+
+AudioIndex = namedtuple(
+    'AudioIndex',
+    ['tracks_index', 'artist_tracks', 'artist_track_rows', 'track_rows',
+     'mean', 'std', 'vectors', 'norms']
+)
+
+ManifestRecord = namedtuple('ManifestRecord', ['path', 'size', 'checksum'])
+
+PYPLOT_CONFIGURED = False
+
+# Read once at import, reading it means setting it, which is not thread
+# safe for parallel writers
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+# requests, seaborn, pandas, matplotlib and skimage take most of startup
+# time, so they are imported on first use, not for ingest or fetch runs
+
+
+def import_requests():
+    import requests
+    requests.packages.urllib3.disable_warnings()
+    return requests
+
+
+def import_pyplot():
+    global PYPLOT_CONFIGURED
+    import seaborn
+    from matplotlib import pyplot as plt
+    if not PYPLOT_CONFIGURED:
+        from matplotlib import rc
+        # For cyrillic labels, once, not to override user settings
+        rc('font', family='Verdana', weight='normal')
+        PYPLOT_CONFIGURED = True
+    return plt
+
+
+def get_checksum(data):
+    return md5(data).hexdigest()
+
+
+def fsync_path(path):
+    file = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(file)
+    finally:
+        os.close(file)
+
+
+def is_dump_tmp_filename(filename):
+    return filename.startswith('.') and filename.endswith('.tmp')
+
+
+def dump_file(path, data, batch=None):
+    dir = os.path.dirname(path) or '.'
+    file, tmp = mkstemp(dir=dir, prefix='.', suffix='.tmp')
+    with os.fdopen(file, 'w') as file:
+        file.write(data)
+    # mkstemp creates files with 0600, match files written with open
+    os.chmod(tmp, 0666 & ~UMASK)
+    os.rename(tmp, path)
+    record = ManifestRecord(path, len(data), get_checksum(data))
+    if batch is None:
+        flush_dumps([record])
+    else:
+        batch.append(record)
+        if len(batch) >= DUMPS_BATCH:
+            flush_dumps(batch)
+
+
+@contextmanager
+def lock_manifest(operation):
+    # Shared for appending writers, exclusive for repair_dumps that
+    # replaces the manifest
+    file = os.open(DUMPS_MANIFEST_LOCK, os.O_RDWR | os.O_CREAT, 0666)
+    try:
+        fcntl.flock(file, operation)
+        yield
+    finally:
+        os.close(file)
+
+
+def append_manifest(records):
+    data = ''.join(json.dumps(_) + '\n' for _ in records)
+    with lock_manifest(fcntl.LOCK_SH):
+        file = os.open(
+            DUMPS_MANIFEST,
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+            0666
+        )
+        try:
+            # Single write, so lines of parallel writers do not interleave
+            written = os.write(file, data)
+            if written != len(data):
+                raise IOError('Short write to {path}'.format(path=DUMPS_MANIFEST))
+            os.fsync(file)
+        finally:
+            os.close(file)
+
+
+def flush_dumps(records):
+    if not records:
+        return
+    # Data is not synced file by file, that is what makes dumps slow. After
+    # a crash a listed file with lost data fails verify_dumps on size or
+    # checksum, an unlisted one fails to parse
+    for dir in set(os.path.dirname(_.path) or '.' for _ in records):
+        fsync_path(dir)
+    append_manifest(records)
+    del records[:]
+
+
+@contextmanager
+def dumps_batch():
+    batch = []
+    try:
+        yield batch
+    finally:
+        flush_dumps(batch)
 
 
 def call_lastfm(**parameters):
+    requests = import_requests()
     parameters['api_key'] = LASTFM_KEY
     response = requests.get(
         LASTFM_API,
@@ -114,10 +244,17 @@ def load_lastfm_tracks_page(page):
         return file.read()
 
 
-def dump_lastfm_tracks_page(data, page):
+def dump_lastfm_tracks_page(data, page, batch=None):
     path = get_lastfm_tracks_page_path(page)
-    with open(path, 'w') as file:
-        file.write(data)
+    dump_file(path, data, batch)
+
+
+def fetch_lastfm_tracks_pages(pages, user='AlexKuk'):
+    with dumps_batch() as batch:
+        for page in pages:
+            if not os.path.exists(get_lastfm_tracks_page_path(page)):
+                data = download_lastfm_tracks_page(page, user=user)
+                dump_lastfm_tracks_page(data, page, batch)
 
 
 def parse_timestamp(timestamp):
@@ -150,7 +287,8 @@ def parse_lastfm_tracks_page(data):
 
 def list_lastfm_tracks_pages():
     for filename in os.listdir(LASTFM_DIR):
-        yield parse_lastfm_tracks_page_filename(filename)
+        if not is_dump_tmp_filename(filename):
+            yield parse_lastfm_tracks_page_filename(filename)
 
 
 def load_raw_lastfm_tracks():
@@ -170,13 +308,12 @@ def serialize_timestamp(timestamp):
 
 
 def dump_lastfm_tracks(tracks, path=LASTFM_TRACKS):
-    with open(path, 'w') as file:
-        data = [
-            ((_.artist.name, _.artist.image),
-             (_.album.name, _.album.image, _.album.mbid),
-             _.name, serialize_timestamp(_.timestamp), _.loved)
-            for _ in tracks]
-        file.write(cjson.encode(data))
+    data = [
+        ((_.artist.name, _.artist.image),
+         (_.album.name, _.album.image, _.album.mbid),
+         _.name, serialize_timestamp(_.timestamp), _.loved)
+        for _ in tracks]
+    dump_file(path, cjson.encode(data))
 
 
 def load_lastfm_tracks(path=LASTFM_TRACKS):
@@ -196,6 +333,7 @@ def load_lastfm_tracks(path=LASTFM_TRACKS):
 
 
 def call_echonest(method, **parameters):
+    requests = import_requests()
     parameters['api_key'] = ECHONEST_KEY
     parameters['format'] = 'json'
     response = requests.get(
@@ -248,10 +386,18 @@ def load_echonest_track_serp(query):
         return json.load(file)
 
 
-def dump_echonest_track_serp(serp, query):
+def dump_echonest_track_serp(serp, query, batch=None):
     path = get_echonest_track_serp_path(query)
-    with open(path, 'w') as file:
-        json.dump(serp, file)
+    dump_file(path, json.dumps(serp), batch)
+
+
+def fetch_echonest_track_serps(tracks):
+    queries = {get_track_artist_track(_) for _ in tracks}
+    with dumps_batch() as batch:
+        for query in queries:
+            if not os.path.exists(get_echonest_track_serp_path(query)):
+                serp = download_echonest_track_serp(query)
+                dump_echonest_track_serp(serp, query, batch)
 
 
 def parse_echonest_track_serp(data):
@@ -297,18 +443,17 @@ def load_echonest_serps(tracks):
 
 
 def dump_echonest_serps(serps, path=ECHONEST_SERPS):
-    with open(path, 'w') as file:
-        data = [
-            (
-                tuple(query),
-                [
-                    (track.artist, track.name, tuple(track.audio))
-                    for track in serp
-                ]
-            )
-            for query, serp in serps.iteritems()
-        ]
-        file.write(cjson.encode(data))
+    data = [
+        (
+            tuple(query),
+            [
+                (track.artist, track.name, tuple(track.audio))
+                for track in serp
+            ]
+        )
+        for query, serp in serps.iteritems()
+    ]
+    dump_file(path, cjson.encode(data))
 
 
 def load_echonest_serps(path=ECHONEST_SERPS):
@@ -327,6 +472,7 @@ def load_echonest_serps(path=ECHONEST_SERPS):
 
 
 def call_musicbrainz(*path, **parameters):
+    requests = import_requests()
     parameters['fmt'] = 'json'
     response = requests.get(
         os.path.join(MUSICBRAINZ_API, *path),
@@ -362,10 +508,18 @@ def load_musicbrainz_release(mbid):
         return json.load(file)
 
 
-def dump_musicbrainz_release(data, mbid):
+def dump_musicbrainz_release(data, mbid, batch=None):
     path = get_musicbrainz_release_path(mbid)
-    with open(path, 'w') as file:
-        json.dump(data, file)
+    dump_file(path, json.dumps(data), batch)
+
+
+def fetch_musicbrainz_releases(tracks):
+    mbids = {_.album.mbid for _ in tracks if _.album.mbid is not None}
+    with dumps_batch() as batch:
+        for mbid in mbids:
+            if not os.path.exists(get_musicbrainz_release_path(mbid)):
+                data = download_musicbrainz_release(mbid)
+                dump_musicbrainz_release(data, mbid, batch)
 
 
 def parse_musicbrainz_release(data):
@@ -381,7 +535,8 @@ def parse_musicbrainz_release(data):
 
 def list_musicbrainz_releases():
     for filename in os.listdir(MUSICBRAINZ_DIR):
-        yield parse_musicbrainz_release_filename(filename)
+        if not is_dump_tmp_filename(filename):
+            yield parse_musicbrainz_release_filename(filename)
 
 
 def load_musicbrainz_releases():
@@ -415,14 +570,212 @@ def join_lastfm_echonest(tracks, serps, releases):
         )
 
 
-def filter_tracks_by_listened(tracks, start=datetime.strptime('2009-03-02', '%Y-%m-%d')):
+def filter_tracks_by_listened(tracks, start=datetime.strptime('2009-03-02', '%Y-%m-%d'),
+                              end=None):
     for track in tracks:
         listened = track.listened
-        if listened and listened >= start:
+        if listened and listened >= start and (end is None or listened < end):
             yield track
 
 
+def get_track_listened_order(track):
+    # Tracks without timestamp go last
+    listened = track.listened
+    return listened is None, listened
+
+
+def index_postings(postings):
+    return {
+        key: np.array(positions, dtype=np.int64)
+        for key, positions in postings.iteritems()
+    }
+
+
+def index_tracks(tracks):
+    tracks = sorted(tracks, key=get_track_listened_order)
+    timestamps = []
+    artists = defaultdict(list)
+    artist_tracks = defaultdict(list)
+    for position, track in enumerate(tracks):
+        if track.listened:
+            timestamps.append(serialize_timestamp(track.listened))
+        artists[track.artist.name].append(position)
+        artist_tracks[get_track_artist_track(track)].append(position)
+    return TracksIndex(
+        tracks,
+        np.array(timestamps, dtype=np.float64),
+        index_postings(artists),
+        index_postings(artist_tracks)
+    )
+
+
+def get_index_listened_range(index, start=None, end=None):
+    if start is None and end is None:
+        return 0, len(index.tracks)
+    timestamps = index.timestamps
+    low, high = 0, len(timestamps)
+    if start is not None:
+        low = np.searchsorted(timestamps, serialize_timestamp(start), side='left')
+    if end is not None:
+        high = np.searchsorted(timestamps, serialize_timestamp(end), side='left')
+    return low, max(low, high)
+
+
+def get_index_postings(postings, keys):
+    arrays = [postings[_] for _ in set(keys) if _ in postings]
+    if not arrays:
+        return np.empty(0, dtype=np.int64)
+    elif len(arrays) == 1:
+        return arrays[0]
+    else:
+        return np.unique(np.concatenate(arrays))
+
+
+def query_tracks_positions(index, start=None, end=None,
+                           artists=None, artist_tracks=None):
+    low, high = get_index_listened_range(index, start, end)
+    positions = None
+    if artists is not None:
+        positions = get_index_postings(index.artists, artists)
+    if artist_tracks is not None:
+        selected = get_index_postings(index.artist_tracks, artist_tracks)
+        if positions is None:
+            positions = selected
+        else:
+            positions = np.intersect1d(positions, selected, assume_unique=True)
+    if positions is None:
+        return np.arange(low, high)
+    # Postings are sorted by listened, so time range is a contiguous slice
+    return positions[
+        np.searchsorted(positions, low):np.searchsorted(positions, high)
+    ]
+
+
+def query_tracks(index, start=None, end=None, artists=None, artist_tracks=None):
+    tracks = index.tracks
+    positions = query_tracks_positions(index, start, end, artists, artist_tracks)
+    for position in positions:
+        yield tracks[position]
+
+
+def normalize_audio(mean, std, audios):
+    # Missing features come as None, they turn into NaN and then into mean
+    audios = np.array(audios, dtype=np.float64)
+    audios = audios.reshape(-1, len(EchonestAudio._fields))
+    vectors = (audios - mean) / std
+    vectors[np.isnan(vectors)] = 0
+    return vectors.astype(np.float32)
+
+
+def index_audio(index):
+    artist_tracks = []
+    artist_track_rows = {}
+    audios = []
+    track_rows = np.empty(len(index.tracks), dtype=np.int64)
+    for position, track in enumerate(index.tracks):
+        row = -1
+        if track.audio:
+            artist_track = get_track_artist_track(track)
+            row = artist_track_rows.get(artist_track)
+            if row is None:
+                row = len(artist_tracks)
+                artist_track_rows[artist_track] = row
+                artist_tracks.append(artist_track)
+                audios.append(track.audio)
+        track_rows[position] = row
+    data = np.array(audios, dtype=np.float64)
+    data = data.reshape(-1, len(EchonestAudio._fields))
+    with warnings.catch_warnings():
+        # No audio at all or a feature missing for every track
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.nan_to_num(np.nanmean(data, axis=0))
+        std = np.nan_to_num(np.nanstd(data, axis=0))
+    std[std == 0] = 1
+    vectors = normalize_audio(mean, std, audios)
+    norms = (vectors ** 2).sum(axis=1)
+    return AudioIndex(
+        index, artist_tracks, artist_track_rows, track_rows,
+        mean, std, vectors, norms
+    )
+
+
+def get_audio_candidate_rows(index, start=None, end=None):
+    # None for all rows
+    if start is None and end is None:
+        return None
+    low, high = get_index_listened_range(index.tracks_index, start, end)
+    rows = np.unique(index.track_rows[low:high])
+    return rows[rows >= 0]
+
+
+def get_audio_query(index, query):
+    if type(query) is ArtistTrack:
+        artist_track, audio = query, None
+    else:
+        artist_track, audio = get_track_artist_track(query), query.audio
+    row = index.artist_track_rows.get(artist_track)
+    if row is not None:
+        return row, index.vectors[row]
+    elif audio:
+        return -1, normalize_audio(index.mean, index.std, [audio])[0]
+
+
+def get_audio_candidate_column(rows, row):
+    if row < 0:
+        return None
+    elif rows is None:
+        return row
+    column = np.searchsorted(rows, row)
+    if column < len(rows) and rows[column] == row:
+        return column
+
+
+def get_similar_artist_tracks_batch(index, queries, k=10, start=None, end=None):
+    rows = get_audio_candidate_rows(index, start, end)
+    if rows is None:
+        vectors, norms = index.vectors, index.norms
+    else:
+        vectors, norms = index.vectors[rows], index.norms[rows]
+    queries = [get_audio_query(index, _) for _ in queries]
+    similar = [[] for _ in queries]
+    found = [number for number, query in enumerate(queries) if query]
+    top = min(k, len(vectors))
+    if not found or not top:
+        return similar
+    size = max(1, AUDIO_DISTANCES_BLOCK // (vectors.itemsize * len(vectors)))
+    size = min(size, len(found))
+    buffer = np.empty((size, len(vectors)), dtype=np.float32)
+    for offset in xrange(0, len(found), size):
+        numbers = found[offset:offset + size]
+        query_vectors = np.array([queries[_][1] for _ in numbers])
+        # Squared euclidean distance without the constant query norm,
+        # in place not to allocate temporary blocks
+        distances = buffer[:len(numbers)]
+        np.dot(query_vectors, vectors.T, out=distances)
+        distances *= -2
+        distances += norms
+        for number, distance in zip(numbers, distances):
+            column = get_audio_candidate_column(rows, queries[number][0])
+            if column is not None:
+                distance[column] = np.inf
+            columns = np.argpartition(distance, top - 1)[:top]
+            columns = columns[np.argsort(distance[columns])]
+            columns = columns[distance[columns] < np.inf]
+            if rows is not None:
+                columns = rows[columns]
+            similar[number] = [index.artist_tracks[_] for _ in columns]
+    return similar
+
+
+def get_similar_artist_tracks(index, query, k=10, start=None, end=None):
+    similar = get_similar_artist_tracks_batch(index, [query], k, start, end)
+    for artist_track in similar[0]:
+        yield artist_track
+
+
 def show_tracks_by_time(tracks):
+    import pandas as pd
+    plt = import_pyplot()
     table = pd.DataFrame([_.listened for _ in tracks], columns=['listened'])
     table = table.groupby('listened').size()
     table = table.resample('W', how='sum')
@@ -453,6 +806,8 @@ def shorten_string(string, top=20):
 
 
 def show_tracks_by_artist_track_by_time(tracks, rows=5, columns=5, size=(20, 20)):
+    import pandas as pd
+    plt = import_pyplot()
     table = pd.DataFrame(
         [(_.listened, _.artist.name, _.name) for _ in tracks],
         columns=['listened', 'artist', 'track']
@@ -485,6 +840,8 @@ def filter_tracks_by_artists(tracks, artists):
 
 
 def show_tracks_by_artist_by_time(tracks, rows=5, columns=5, size=(20, 20)):
+    import pandas as pd
+    plt = import_pyplot()
     table = pd.DataFrame(
         [(_.listened, _.artist.name) for _ in tracks],
         columns=['listened', 'artist']
@@ -506,6 +863,8 @@ def format_artist_track(artist_track):
 
 def show_selected_tracks_artists(tracks, artist_tracks, artists,
                                  rows=5, columns=5, width=20, height=20):
+    import pandas as pd
+    plt = import_pyplot()
     data = defaultdict(Counter)
     for track in tracks:
         listened = track.listened
@@ -576,6 +935,8 @@ def show_day_first_times(
     get_name=get_track_artist_track,
     ylabel='share of tracks played first time (avg. by months)'
 ):
+    import pandas as pd
+    plt = import_pyplot()
     first_time_in_week = get_listened_first_time(tracks, window=7, get_name=get_name)
     first_time_in_month = get_listened_first_time(tracks, window=30, get_name=get_name)
     first_time_in_6_months = get_listened_first_time(tracks, window=120, get_name=get_name)
@@ -599,6 +960,8 @@ def show_day_listen_repetitions(
     tracks, get_name=get_track_artist_track,
     ylabel='share of track freq. per day avg. by months'
 ):
+    import pandas as pd
+    plt = import_pyplot()
     day_names = defaultdict(list)
     for track in tracks:
         listened = track.listened
@@ -632,6 +995,8 @@ def show_day_listen_repetitions(
 
 
 def show_year_coverage_by_time(tracks):
+    import pandas as pd
+    plt = import_pyplot()
     data = [(_.listened, _.album.year is not None) for _ in tracks]
     table = pd.DataFrame(data, columns=['listened', 'year'])
     table = table.groupby(['listened', 'year']).size()
@@ -645,6 +1010,8 @@ def show_year_coverage_by_time(tracks):
 
 
 def show_album_year_by_time(tracks):
+    import pandas as pd
+    plt = import_pyplot()
     data = [(_.listened, _.album.year) for _ in tracks]
     table = pd.DataFrame(data, columns=['listened', 'year'])
     table = table.set_index('listened').year
@@ -658,6 +1025,8 @@ def show_album_year_by_time(tracks):
 
 
 def show_echonest_coverage_by_time(tracks):
+    import pandas as pd
+    import_pyplot()
     data = [(_.listened, _.audio is not None) for _ in tracks]
     table = pd.DataFrame(data, columns=['listened', 'echonest'])
     table = table.groupby(['listened', 'echonest']).size()
@@ -668,6 +1037,7 @@ def show_echonest_coverage_by_time(tracks):
 
 
 def get_audio_table(tracks):
+    import pandas as pd
     data = [(_.listened, _.audio.energy, _.audio.liveness,
               _.audio.tempo, _.audio.speechiness, _.audio.acousticness,
               _.audio.danceability, _.audio.instrumentalness,
@@ -685,12 +1055,14 @@ def get_audio_table(tracks):
 
 
 def show_audio_by_time(tracks):
+    import_pyplot()
     table = get_audio_table(tracks)
     table = table.resample('M', how='mean')
     table.plot(subplots=True, figsize=(15, 15), layout=(4, -1))
 
 
 def show_selected_tracks_audio_by_time(tracks):
+    plt = import_pyplot()
     table = get_audio_table(tracks)
     fig, axis = plt.subplots(2, 2)
     for feature, ax in zip(
@@ -717,6 +1089,7 @@ def download_cover(url):
 
 
 def read_covers():
+    from skimage import io
     for filename in os.listdir(COVERS_DIR):
         if filename.endswith('.png'):
             path = os.path.join(COVERS_DIR, filename)
@@ -725,6 +1098,7 @@ def read_covers():
                 yield cover
 
 def build_covers_grid(rows=6, columns=9):
+    from skimage import io
     covers = read_covers()
     grid = []
     for row in xrange(rows):
@@ -739,3 +1113,127 @@ def build_covers_grid(rows=6, columns=9):
         rows.append(row)
     image = np.concatenate(rows, axis=0)
     io.imsave(COVERS_GRID, image)
+
+
+def load_manifest():
+    manifest = {}
+    if os.path.exists(DUMPS_MANIFEST):
+        with open(DUMPS_MANIFEST) as file:
+            for line in file:
+                try:
+                    record = ManifestRecord(*json.loads(line))
+                except (ValueError, TypeError):
+                    # Torn last line after a crash
+                    continue
+                manifest[record.path] = record
+    return manifest
+
+
+def dump_manifest(manifest):
+    tmp = DUMPS_MANIFEST + '.tmp'
+    with open(tmp, 'w') as file:
+        for record in manifest.itervalues():
+            file.write(json.dumps(record) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+    os.rename(tmp, DUMPS_MANIFEST)
+    fsync_path(os.path.dirname(DUMPS_MANIFEST) or '.')
+
+
+def read_file_record(path):
+    with open(path) as file:
+        data = file.read()
+    return ManifestRecord(path, len(data), get_checksum(data))
+
+
+def is_dump_parsed(path):
+    with open(path) as file:
+        data = file.read()
+    try:
+        if path.endswith('.xml'):
+            ElementTree.fromstring(data)
+        elif path.endswith('.json'):
+            json.loads(data)
+    except (ValueError, ElementTree.ParseError):
+        return False
+    return True
+
+
+def list_dumps_filenames():
+    for dir in (LASTFM_DIR, ECHONEST_DIR, MUSICBRAINZ_DIR):
+        if os.path.isdir(dir):
+            for filename in os.listdir(dir):
+                yield dir, filename
+
+
+def list_unlisted_dumps(manifest):
+    for dir, filename in list_dumps_filenames():
+        path = os.path.join(dir, filename)
+        if not is_dump_tmp_filename(filename) and path not in manifest:
+            yield path
+
+
+def list_stale_dumps_tmps():
+    now = time()
+    for dir, filename in list_dumps_filenames():
+        path = os.path.join(dir, filename)
+        if is_dump_tmp_filename(filename):
+            if now - os.path.getmtime(path) > DUMPS_TMP_TTL:
+                yield path
+
+
+def verify_dumps(manifest, checksum=False):
+    for path, record in manifest.iteritems():
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            yield path
+            continue
+        if size != record.size:
+            yield path
+        elif checksum and read_file_record(path) != record:
+            yield path
+    # Written before the manifest or by a run killed before listing them
+    for path in list_unlisted_dumps(manifest):
+        if not is_dump_parsed(path):
+            yield path
+
+
+def repair_dumps(checksum=False):
+    # Running writers wait for repair before appending to the manifest
+    with lock_manifest(fcntl.LOCK_EX):
+        repair_locked_dumps(checksum)
+
+
+def repair_locked_dumps(checksum=False):
+    manifest = load_manifest()
+    for path in list(verify_dumps(manifest, checksum)):
+        print >>sys.stderr, 'Remove {path}'.format(path=path)
+        if os.path.exists(path):
+            os.remove(path)
+        manifest.pop(path, None)
+    # Broken ones are removed above, the rest parse
+    for path in list_unlisted_dumps(manifest):
+        manifest[path] = read_file_record(path)
+    for path in list_stale_dumps_tmps():
+        print >>sys.stderr, 'Remove {path}'.format(path=path)
+        os.remove(path)
+    dump_manifest(manifest)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('command', choices=['verify', 'repair'])
+    parser.add_argument(
+        '--checksum', action='store_true',
+        help='compare checksums, not only sizes'
+    )
+    args = parser.parse_args()
+    if args.command == 'verify':
+        broken = 0
+        for path in verify_dumps(load_manifest(), args.checksum):
+            print path
+            broken += 1
+        sys.exit(1 if broken else 0)
+    else:
+        repair_dumps(args.checksum)
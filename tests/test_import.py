@@ -0,0 +1,43 @@
+import os
+import sys
+import json
+import unittest
+from subprocess import check_output
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['requests', 'pandas', 'matplotlib', 'seaborn', 'skimage']
+# Fetch workers should start well under a second
+IMPORT_TIME_LIMIT = 0.5
+
+IMPORT_MAIN = '''
+import sys
+import json
+from time import time
+start = time()
+import main
+print(json.dumps({
+    'time': time() - start,
+    'modules': [_ for _ in %r if _ in sys.modules]
+}))
+''' % HEAVY_MODULES
+
+
+def import_main():
+    # Fresh interpreter, otherwise modules imported by the test runner
+    # itself count
+    output = check_output([sys.executable, '-c', IMPORT_MAIN], cwd=ROOT)
+    return json.loads(output.decode('utf8').splitlines()[-1])
+
+
+class TestImport(unittest.TestCase):
+    def test_heavy_modules_are_lazy(self):
+        self.assertEqual(import_main()['modules'], [])
+
+    def test_import_time(self):
+        self.assertLess(import_main()['time'], IMPORT_TIME_LIMIT)
+
+
+if __name__ == '__main__':
+    unittest.main()